@@ -1,6 +1,9 @@
 from models import *
+from fastapi import WebSocket, WebSocketDisconnect
 import fastapi_jsonrpc as jsonrpc
 import uvicorn
+import asyncio
+import threading
 import time
 import contextlib
 import json
@@ -8,15 +11,45 @@ import decimal
 
 decimal.getcontext().prec = 64
 
-indexer = None
+config = None
+chainflip = None
+chainflip_lock = threading.Lock()
 api_v1 = jsonrpc.Entrypoint("/api/v1/jsonrpc")
 
+MAX_HISTORY_POINTS = 1000
+RPC_BATCH_SIZE = 250
+RPC_TIMEOUT = 30
+
+# address -> queues of the websockets subscribed to it
+subscribers = {}
+
+
+# heavy substrate imports and the node connection are only paid for on first use
+def get_chainflip():
+    global chainflip
+    with chainflip_lock:
+        if chainflip is None:
+            from substrateinterface import SubstrateInterface
+
+            chainflip = SubstrateInterface(url=config["node_substrate"])
+    return chainflip
+
 
 class InvalidBlockHeight(jsonrpc.BaseError):
     CODE = -32001
     MESSAGE = "invalid block height"
 
 
+class InvalidHistoryRange(jsonrpc.BaseError):
+    CODE = -32002
+    MESSAGE = "invalid history range"
+
+
+class BatchingUnsupported(jsonrpc.BaseError):
+    CODE = -32003
+    MESSAGE = "balance history requires an http substrate node"
+
+
 @api_v1.method(errors=[InvalidBlockHeight])
 def get_balance(address: str, ethereum_height: int, chainflip_height: int) -> dict:
     if ethereum_height == 0:
@@ -78,8 +111,8 @@ def get_balance(address: str, ethereum_height: int, chainflip_height: int) -> di
     ):
         uncompleted_claims += claim.amount
 
-    block_hash = indexer.chainflip.get_block_hash(chainflip_height)
-    validator_balance = indexer.chainflip.query(
+    block_hash = get_chainflip().get_block_hash(chainflip_height)
+    validator_balance = get_chainflip().query(
         module="Flip",
         storage_function="Account",
         block_hash=block_hash,
@@ -105,6 +138,206 @@ def get_balance(address: str, ethereum_height: int, chainflip_height: int) -> di
     return r
 
 
+def _sweep(entries: list, heights: list):
+    """
+    walks entries sorted by height alongside ascending sample heights, yielding
+    the sum of amounts below and up to each sample height
+    """
+    below = 0
+    upto = 0
+    i = 0
+    j = 0
+    for height in heights:
+        while i < len(entries) and entries[i][0] < height:
+            below += entries[i][1]
+            i += 1
+        while j < len(entries) and entries[j][0] <= height:
+            upto += entries[j][1]
+            j += 1
+        yield below, upto
+
+
+def rpc_batch(method: str, params_list: list) -> list:
+    # only http nodes are batched, get_balance_history checks the node before calling this
+    import requests
+
+    results = []
+    for offset in range(0, len(params_list), RPC_BATCH_SIZE):
+        batch = params_list[offset : offset + RPC_BATCH_SIZE]
+        responses = requests.post(
+            config["node_substrate"],
+            json=[
+                {"jsonrpc": "2.0", "id": i, "method": method, "params": params}
+                for i, params in enumerate(batch)
+            ],
+            timeout=RPC_TIMEOUT,
+        ).json()
+
+        # nodes that reject a whole batch answer with a single error object
+        if not isinstance(responses, list):
+            raise Exception("{} batch rejected: {}".format(method, responses))
+
+        responses = {response["id"]: response for response in responses}
+        for i in range(len(batch)):
+            if i not in responses or "error" in responses[i]:
+                raise Exception(
+                    "{} failed: {}".format(method, responses.get(i, {}).get("error"))
+                )
+            results.append(responses[i]["result"])
+
+    return results
+
+
+def get_stakes_at(address: str, heights: list) -> list:
+    # Flip.Account is read at the sample heights only, in batched requests
+    from scalecodec import ScaleBytes
+
+    chainflip = get_chainflip()
+    storage_key = chainflip.create_storage_key(
+        pallet="Flip", storage_function="Account", params=[address]
+    )
+
+    block_hashes = rpc_batch("chain_getBlockHash", [[height] for height in heights])
+    values = rpc_batch(
+        "state_getStorage",
+        [[storage_key.to_hex(), block_hash] for block_hash in block_hashes],
+    )
+    versions = rpc_batch(
+        "state_getRuntimeVersion", [[block_hash] for block_hash in block_hashes]
+    )
+
+    # the stake only changes every few epochs, so each distinct value is decoded once per runtime
+    decoded = {}
+    stakes = []
+    for block_hash, data, version in zip(block_hashes, values, versions):
+        if data is None:
+            stakes.append(0)
+            continue
+
+        key = (version["specVersion"], data)
+        if key not in decoded:
+            account = chainflip.decode_scale(
+                storage_key.value_scale_type, ScaleBytes(data), block_hash=block_hash
+            )
+            decoded[key] = float(str(account["stake"]))
+        stakes.append(decoded[key])
+
+    return stakes
+
+
+@api_v1.method(
+    errors=[InvalidBlockHeight, InvalidHistoryRange, BatchingUnsupported]
+)
+def get_balance_history(
+    address: str,
+    from_height: int,
+    to_height: int,
+    step: int,
+    ethereum_height: int = 0,
+) -> list:
+    # heights are chainflip heights, all samples are taken against the same ethereum height
+    if not config["node_substrate"].startswith("http"):
+        raise BatchingUnsupported()
+
+    if ethereum_height == 0:
+        ethereum_height = State[1].ethereum_height
+    if to_height == 0:
+        to_height = State[1].chainflip_height
+
+    if (
+        State[1].chainflip_height < to_height
+        or State[1].ethereum_height < ethereum_height
+    ):
+        raise InvalidBlockHeight()
+
+    if step <= 0 or from_height < 0 or from_height > to_height:
+        raise InvalidHistoryRange()
+
+    if (to_height - from_height) // step + 1 > MAX_HISTORY_POINTS:
+        raise InvalidHistoryRange()
+
+    heights = list(range(from_height, to_height + 1, step))
+
+    # stakes are bucketed by their chainflip height, claims by their chainflip initiation
+    initiated_stakes = []
+    uninitiated_stakes = []
+    for stake in (
+        Stake.select(Stake.amount, Stake.initiated_height, Stake.completed_height)
+        .where(
+            Stake.address == address,
+            Stake.initiated_height.is_null(False),
+            Stake.completed_height.is_null(False),
+        )
+        .order_by(Stake.completed_height)
+    ):
+        if stake.initiated_height <= ethereum_height:
+            initiated_stakes.append((stake.completed_height, stake.amount))
+        else:
+            uninitiated_stakes.append((stake.completed_height, stake.amount))
+
+    pending_claims = []
+    completed_claims = []
+    for claim in (
+        Claim.select(Claim.amount, Claim.initiated_height, Claim.completed_height)
+        .where(
+            Claim.node == address,
+            Claim.initiated_height.is_null(False),
+            Claim.completed_height.is_null(False),
+        )
+        .order_by(Claim.initiated_height)
+    ):
+        if claim.completed_height >= ethereum_height:
+            pending_claims.append((claim.initiated_height, claim.amount))
+        if claim.completed_height <= ethereum_height:
+            completed_claims.append((claim.initiated_height, claim.amount))
+
+    initiated_total = sum(amount for _, amount in initiated_stakes)
+    completed_claims_total = sum(amount for _, amount in completed_claims)
+
+    validator_balances = get_stakes_at(address, heights)
+
+    history = []
+    for (
+        height,
+        (initiated_below, initiated_upto),
+        (_, uninitiated_upto),
+        (_, pending_claims_upto),
+        (_, completed_claims_upto),
+        validator_balance,
+    ) in zip(
+        heights,
+        _sweep(initiated_stakes, heights),
+        _sweep(uninitiated_stakes, heights),
+        _sweep(pending_claims, heights),
+        _sweep(completed_claims, heights),
+        validator_balances,
+    ):
+        staked_amount = (
+            (initiated_total - initiated_below)
+            + initiated_upto
+            - completed_claims_upto
+            - pending_claims_upto
+        )
+        rewards = (
+            validator_balance
+            - staked_amount
+            - uninitiated_upto
+            + (completed_claims_total - completed_claims_upto)
+        )
+
+        history.append(
+            {
+                "address": address,
+                "ethereum_height": ethereum_height,
+                "chainflip_height": height,
+                "staked_balance": decimal.Decimal(staked_amount),
+                "rewards": decimal.Decimal(rewards),
+            }
+        )
+
+    return history
+
+
 # get state of database
 @api_v1.method()
 def get_state() -> dict:
@@ -114,6 +347,73 @@ def get_state() -> dict:
     }
 
 
+def fan_out(notification: dict):
+    for queue in subscribers.get(notification["address"], ()):
+        queue.put_nowait(notification)
+
+
+def forward_notifications(notifications, loop):
+    # blocks on the cross-process queue, so runs in its own thread
+    while True:
+        notification = notifications.get()
+        loop.call_soon_threadsafe(fan_out, notification)
+
+
+async def send_notifications(websocket: WebSocket, queue: asyncio.Queue):
+    while True:
+        await websocket.send_json(await queue.get())
+
+
+def valid_subscription(message) -> bool:
+    if not isinstance(message, dict):
+        return False
+
+    for key in ("subscribe", "unsubscribe"):
+        addresses = message.get(key, [])
+        if not isinstance(addresses, list) or not all(
+            isinstance(address, str) for address in addresses
+        ):
+            return False
+
+    return True
+
+
+# clients send {"subscribe": [addresses]} or {"unsubscribe": [addresses]},
+# and receive {"address", "ethereum_height", "chainflip_height"} whenever the indexer commits a change for one of them
+async def subscribe(websocket: WebSocket):
+    await websocket.accept()
+
+    queue = asyncio.Queue()
+    addresses = set()
+    sender = asyncio.ensure_future(send_notifications(websocket, queue))
+    try:
+        while True:
+            message = await websocket.receive_json()
+            if not valid_subscription(message):
+                await websocket.send_json({"error": "invalid subscription message"})
+                continue
+
+            for address in message.get("subscribe", []):
+                subscribers.setdefault(address, set()).add(queue)
+                addresses.add(address)
+
+            for address in message.get("unsubscribe", []):
+                if address in subscribers:
+                    subscribers[address].discard(queue)
+                    if len(subscribers[address]) == 0:
+                        del subscribers[address]
+                addresses.discard(address)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        for address in addresses:
+            if address in subscribers:
+                subscribers[address].discard(queue)
+                if len(subscribers[address]) == 0:
+                    del subscribers[address]
+
+
 class Server(uvicorn.Server):
     def install_signal_handlers(self):
         pass
@@ -131,12 +431,24 @@ class Server(uvicorn.Server):
             thread.join()
 
 
-def start(indexer_, port):
-    global indexer
-    indexer = indexer_
+def start(config_, port, notifications=None):
+    global config
+    config = config_
 
     app = jsonrpc.API()
     app.bind_entrypoint(api_v1)
+    app.add_api_websocket_route("/api/v1/subscribe", subscribe)
+
+    if notifications is not None:
+
+        async def start_forwarding():
+            threading.Thread(
+                target=forward_notifications,
+                args=(notifications, asyncio.get_running_loop()),
+                daemon=True,
+            ).start()
+
+        app.add_event_handler("startup", start_forwarding)
 
     server = Server(uvicorn.Config(app, host="0.0.0.0", port=port))
     server.run()
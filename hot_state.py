@@ -0,0 +1,197 @@
+from models import *
+from threading import RLock
+import bisect
+
+
+def copy_row(row):
+    return type(row)(**row.__data__)
+
+
+# in memory indexes over the rows event handling looks up, warm-loaded at startup.
+# handlers work on a HotStateChanges and the hot state is only updated once its writes are committed.
+class HotState:
+    def __init__(self):
+        self.lock = RLock()
+
+        self.stakes = {}  # tx hash -> stake
+        self.claims = {}  # msg hash -> claim
+        self.unexpired_claims = {}  # node -> [(id, claim)] ordered by id
+        self.reserved_claims = set()  # ids of claims expired by changes not committed yet
+
+    def load(self):
+        with self.lock:
+            self.stakes = {}
+            self.claims = {}
+            self.unexpired_claims = {}
+
+            for stake in Stake.select().where(Stake.hash.is_null(False)):
+                self.stakes[stake.hash] = stake
+
+            for claim in Claim.select().order_by(Claim.id.asc()):
+                if claim.msg_hash is not None:
+                    self.claims[str(claim.msg_hash)] = claim
+                if claim.expired_height is None:
+                    self.unexpired_claims.setdefault(claim.node, []).append(
+                        (claim.id, claim)
+                    )
+
+    def changes(self):
+        return HotStateChanges(self)
+
+    def put_claim(self, claim: Claim):
+        with self.lock:
+            if claim.msg_hash is not None:
+                self.claims[str(claim.msg_hash)] = claim
+
+            claims = [
+                entry
+                for entry in self.unexpired_claims.get(claim.node, [])
+                if entry[0] != claim.id
+            ]
+            if claim.expired_height is None:
+                bisect.insort(claims, (claim.id, claim))
+
+            if len(claims) == 0:
+                self.unexpired_claims.pop(claim.node, None)
+            else:
+                self.unexpired_claims[claim.node] = claims
+
+
+class HotStateChanges:
+    def __init__(self, hot_state: HotState):
+        self.hot_state = hot_state
+
+        # copies of the rows looked up or created, so nothing leaks into the hot state before commit
+        self.stakes = {}  # tx hash -> stake
+        self.claims = {}  # id -> claim
+        self.claims_by_msg_hash = {}  # msg hash -> claim
+
+        # new rows get their ids from the database when they are written
+        self.created = {Stake: [], Claim: []}
+        self.updated = {Stake: {}, Claim: {}}  # id -> row
+        self.validator_stakes = {}  # address -> stake added
+        self.written = []
+        self.reserved_claims = set()
+
+    def track(self, row):
+        if isinstance(row, Stake):
+            self.stakes[row.hash] = row
+        elif isinstance(row, Claim):
+            if row.id is not None:
+                self.claims[row.id] = row
+            if row.msg_hash is not None:
+                self.claims_by_msg_hash[str(row.msg_hash)] = row
+        return row
+
+    def get_stake(self, hash: str):
+        if hash not in self.stakes:
+            with self.hot_state.lock:
+                stake = self.hot_state.stakes.get(hash)
+                if stake is None:
+                    return None
+                self.track(copy_row(stake))
+        return self.stakes[hash]
+
+    def get_claim(self, msg_hash):
+        key = str(msg_hash)
+        if key not in self.claims_by_msg_hash:
+            with self.hot_state.lock:
+                claim = self.hot_state.claims.get(key)
+                if claim is None:
+                    return None
+                if claim.id not in self.claims:
+                    self.track(copy_row(claim))
+                self.claims_by_msg_hash[key] = self.claims[claim.id]
+        return self.claims_by_msg_hash[key]
+
+    def pop_unexpired_claim(self, node: str):
+        # claims of a node expire in the order they were created, claims created here are the newest
+        with self.hot_state.lock:
+            for id, claim in self.hot_state.unexpired_claims.get(node, []):
+                if id in self.hot_state.reserved_claims or id in self.reserved_claims:
+                    continue
+
+                # reserved so concurrently handled blocks can't expire the same claim
+                self.hot_state.reserved_claims.add(id)
+                self.reserved_claims.add(id)
+                if id not in self.claims:
+                    self.track(copy_row(claim))
+                return self.claims[id]
+
+        for claim in self.created[Claim]:
+            if claim.node == node and claim.expired_height is None:
+                return claim
+
+        return None
+
+    def add_validator_stake(self, address: str, amount):
+        self.validator_stakes[address] = self.validator_stakes.get(address, 0) + amount
+
+    def create(self, row):
+        self.created[type(row)].append(row)
+        return self.track(row)
+
+    def update(self, row):
+        # rows not written yet are inserted with their latest values anyway
+        if row.id is not None:
+            self.updated[type(row)][row.id] = row
+
+    def write(self):
+        # inserted one by one so every row gets the id the database assigned it
+        for model in (Stake, Claim):
+            for row in self.created[model]:
+                row.save(force_insert=True)
+                self.track(row)
+
+        Stake.bulk_update(
+            list(self.updated[Stake].values()),
+            fields=[Stake.initiated_height, Stake.completed_height],
+            batch_size=250,
+        )
+        Claim.bulk_update(
+            list(self.updated[Claim].values()),
+            fields=[
+                Claim.initiated_height,
+                Claim.completed_height,
+                Claim.expired_height,
+                Claim.chainflip_hash,
+                Claim.start_time,
+                Claim.expiry_time,
+                Claim.staker,
+            ],
+            batch_size=250,
+        )
+
+        # added in the database rather than written back, so concurrently handled blocks don't overwrite each other.
+        # the update takes the write lock, so a validator created by another block is seen before inserting it again
+        for address, amount in self.validator_stakes.items():
+            updated = (
+                Validator.update(staked_amount=Validator.staked_amount + amount)
+                .where(Validator.address == address)
+                .execute()
+            )
+            if updated == 0:
+                Validator.create(address=address, staked_amount=amount, rewards=0)
+
+        for model in (Stake, Claim):
+            self.written += self.created[model]
+            self.written += self.updated[model].values()
+            self.created[model] = []
+            self.updated[model] = {}
+        self.validator_stakes = {}
+
+    # called once the transaction the changes were written in has committed
+    def commit(self):
+        with self.hot_state.lock:
+            for row in self.written:
+                if isinstance(row, Stake):
+                    self.hot_state.stakes[row.hash] = row
+                elif isinstance(row, Claim):
+                    self.hot_state.put_claim(row)
+
+            self.hot_state.reserved_claims -= self.reserved_claims
+        self.written = []
+
+    def discard(self):
+        with self.hot_state.lock:
+            self.hot_state.reserved_claims -= self.reserved_claims
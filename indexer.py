@@ -4,10 +4,11 @@
 from substrateinterface import SubstrateInterface
 from substrateinterface.utils.ss58 import ss58_decode, ss58_encode
 from models import *
+from hot_state import HotState, HotStateChanges
 from web3 import Web3
-from utils import logger, get_abi
+from utils import logger, get_abi, start_logging
 from typing import List
-from threading import Thread
+from threading import Thread, Lock
 from tqdm import tqdm
 from retrying import retry
 import json
@@ -46,6 +47,8 @@ class Indexer:
         threading_delay: float = 0.02,
         eth_reorg_protection: int = 2,
         chainflip_reorg_protection: int = 0,
+        notifications=None,
+        verbose_logging: bool = False,
     ):
 
         # create providers
@@ -59,8 +62,13 @@ class Indexer:
         )
 
         self.logger = logger
+        # per event logs and progress bars are opt-in, otherwise only per block summaries are logged
+        self.verbose_logging = verbose_logging
 
+        init_db()
         self.state = State[1]
+        self.hot_state = HotState()
+        self.hot_state.load()
 
         self.batch_size = chainflip_batch_size
         self.thread_delay = threading_delay
@@ -68,17 +76,55 @@ class Indexer:
         self.eth_reorg_protection = eth_reorg_protection
         self.chainflip_reorg_protection = chainflip_reorg_protection
 
+        # queue shared with the api process, addresses touched by a transaction are published once it commits
+        self.notifications = notifications
+        self.changed_addresses = set()
+        self.changed_addresses_lock = Lock()
+
+    # only called with the addresses of committed writes, failed attempts never reach the shared set
+    def mark_changed(self, addresses: set):
+        with self.changed_addresses_lock:
+            self.changed_addresses |= addresses
+
+    def publish_changes(self):
+        with self.changed_addresses_lock:
+            addresses = self.changed_addresses
+            self.changed_addresses = set()
+
+        if self.notifications is None:
+            return
+
+        for address in addresses:
+            self.notifications.put(
+                {
+                    "address": address,
+                    "ethereum_height": self.state.ethereum_height,
+                    "chainflip_height": self.state.chainflip_height,
+                }
+            )
+
     def watch_eth(self):  # ethereum
+        changes = self.hot_state.changes()
+        addresses = set()
+        try:
+            self.sync_eth(changes, addresses)
+        except Exception:
+            changes.discard()
+            raise
+        changes.commit()
+        self.mark_changed(addresses)
+
+        self.publish_changes()
+
+    def sync_eth(self, changes: HotStateChanges, addresses: set):
         with db.atomic():
             self.logger.info("Checking for new stakes")
             previous_height = self.state.ethereum_height
             current_height = self.eth.eth.block_number - self.eth_reorg_protection
-            self.logger.info("Current height: {}".format(current_height))
+            self.logger.info("Current height: %s", current_height)
 
             self.logger.info(
-                "Getting stakes between {} and {}".format(
-                    previous_height, current_height
-                )
+                "Getting stakes between %s and %s", previous_height, current_height
             )
 
             if current_height == previous_height - 1:
@@ -90,26 +136,20 @@ class Indexer:
 
             stakes = event_filter.get_all_entries()
             self.logger.info(
-                "A total of {} stake events found between {} and {}".format(
-                    len(stakes), previous_height, current_height
-                )
+                "A total of %s stake events found between %s and %s",
+                len(stakes),
+                previous_height,
+                current_height,
             )
 
-            id = 0
-            try:
-                id = Stake.select().order_by(Stake.id.desc()).get().id
-            except:
-                pass
-            bulk_stakes = []
-            for stake in tqdm(stakes):
+            for stake in tqdm(stakes, disable=not self.verbose_logging):
                 address = self.chainflip.ss58_encode(stake["args"]["nodeID"].hex())
-                s = Stake.select().where(Stake.hash == stake["transactionHash"].hex())
+                addresses.add(address)
+                s = changes.get_stake(stake["transactionHash"].hex())
 
                 if s == None:
-                    id += 1
-                    bulk_stakes.append(
+                    changes.create(
                         Stake(
-                            id=id,
                             hash=stake["transactionHash"].hex(),
                             amount=stake["args"]["amount"],
                             initiated_height=stake["blockNumber"],
@@ -117,13 +157,12 @@ class Indexer:
                         )
                     )
                 else:
-                    self.logger.info(
-                        "Watch Stakes is behind confirmations, modifying {} stake".format(
-                            stake["transactionHash"].hex()
-                        )
+                    self.logger.debug(
+                        "Watch Stakes is behind confirmations, modifying %s stake",
+                        stake["transactionHash"].hex(),
                     )
                     s.initiated_height = stake["blockNumber"]
-                    s.save()
+                    changes.update(s)
 
             event_filter = self.flip_staker_contract.events.ClaimRegistered.createFilter(
                 fromBlock=hex(previous_height), toBlock=hex(current_height)
@@ -131,18 +170,13 @@ class Indexer:
 
             claims = event_filter.get_all_entries()
             self.logger.info(
-                "A total of {} claim events found between {} and {}".format(
-                    len(claims), previous_height, current_height
-                )
+                "A total of %s claim events found between %s and %s",
+                len(claims),
+                previous_height,
+                current_height,
             )
 
-            id = 0
-            try:
-                id = Claim.select().order_by(Stake.id.desc()).get().id
-            except:
-                pass
-            bulk_claims = []
-            for claim in tqdm(claims):
+            for claim in tqdm(claims, disable=not self.verbose_logging):
                 # get params of transaction
                 tx = self.eth.eth.getTransaction(claim["transactionHash"])
 
@@ -150,34 +184,30 @@ class Indexer:
                 decoded = self.flip_staker_contract.decode_function_input(tx.input)
                 args = decoded[1]
                 msg_hash = args["sigData"][2]
+                node = ss58_encode(args["nodeID"].hex(), CHAINFLIP_SS58_PREFIX)
+                addresses.add(node)
 
-                count = Claim.select().where(Claim.msg_hash == msg_hash).count()
+                existing = changes.get_claim(msg_hash)
 
-                if count == 0:
-                    id += 1
-                    bulk_claims.append(
+                if existing == None:
+                    changes.create(
                         Claim(
-                            id=id,
                             msg_hash=msg_hash,
                             amount=args["amount"],
-                            node=ss58_encode(
-                                args["nodeID"].hex(), CHAINFLIP_SS58_PREFIX
-                            ),
+                            node=node,
                             start_time=claim["args"]["startTime"],
                             expiry_time=claim["args"]["expiryTime"],
                             staker=claim["args"]["staker"],
                         )
                     )
                 else:
-                    claim = Claim.select().where(Claim.msg_hash == msg_hash).get()
-                    claim.start_time = claim["args"]["startTime"]
-                    claim.expiry_time = claim["args"]["expiryTime"]
-                    claim.staker = claim["args"]["staker"]
-                    claim.save()
+                    existing.start_time = claim["args"]["startTime"]
+                    existing.expiry_time = claim["args"]["expiryTime"]
+                    existing.staker = claim["args"]["staker"]
+                    changes.update(existing)
 
             self.logger.info("Paired up all stakes, inserting...")
-            Stake.bulk_create(bulk_stakes, batch_size=250)
-            Claim.bulk_create(bulk_claims, batch_size=250)
+            changes.write()
 
             event_filter = self.flip_staker_contract.events.ClaimExecuted.createFilter(
                 fromBlock=hex(previous_height), toBlock=hex(current_height)
@@ -202,7 +232,7 @@ class Indexer:
                 )
 
                 if exists == 0:
-                    self.logger.fatal("Claim {} not found".format(event["args"]))
+                    self.logger.fatal("Claim %s not found", event["args"])
 
                     raise Exception("Claim not found")
                 else:
@@ -216,23 +246,58 @@ class Indexer:
                         )
                         .get()
                     )
+                    if claim.msg_hash is not None:
+                        claim = changes.get_claim(claim.msg_hash)
+                    else:
+                        changes.track(claim)
 
-                    self.logger.info("Claim {} completed".format(claim.id))
+                    self.logger.debug("Claim %s completed", claim.id)
                     claim.completed_height = event["blockNumber"]
-                    claim.save()
+                    changes.update(claim)
+                    addresses.add(claim.node)
+
+            changes.write()
 
             self.state.ethereum_height = current_height + 1
             self.state.save()
 
     @retry(stop_max_attempt_number=MAX_CALL_RETRIES)
-    def index_chainflip_block(
-        self, block: int
+    def index_chainflip_block(self, block: int, save_height: bool = False):
+        # each attempt writes in its own transaction, which must be the outermost one,
+        # and only reaches the hot state once that transaction has committed
+        changes = self.hot_state.changes()
+        addresses = set()
+        try:
+            with db.atomic():
+                result = self.handle_chainflip_block(block, changes, addresses)
+                changes.write()
+
+                if save_height:
+                    State.update(chainflip_height=block).where(
+                        State.id == self.state.id
+                    ).execute()
+        except Exception:
+            changes.discard()
+            raise
+        changes.commit()
+        self.mark_changed(addresses)
+
+        if save_height:
+            self.state.chainflip_height = block
+
+        return result
+
+    def handle_chainflip_block(
+        self, block: int, changes: HotStateChanges, addresses: set
     ):  # gets according stakes on the chainflip chain
         hash = self.chainflip.get_block_hash(block)
 
         events = self.chainflip.get_events(hash)
-        self.logger.info("Block {} has {} events".format(block, len(events)))
+        self.logger.debug("Block %s has %s events", block, len(events))
 
+        stakes = 0
+        claims = 0
+        expired_claims = 0
         for event in events:
             # figure out unstakes as well
             if event.value["event_id"] == "Staked":
@@ -245,59 +310,42 @@ class Indexer:
                     "stake_added": args[2],
                     "stake_total": args[3],
                 }
+                addresses.add(args["account_id"])
+                stakes += 1
 
-                self.logger.info(
-                    "index: {}, args {}".format(event.value["extrinsic_idx"], args)
+                self.logger.debug(
+                    "index: %s, args %s", event.value["extrinsic_idx"], args
                 )
 
-                stake = Stake.select().where(Stake.hash == args["tx_hash"]).first()
+                stake = changes.get_stake(args["tx_hash"])
                 if stake == None:
-                    self.logger.warning("Stake not found for event: {}".format(event))
-                    stake = Stake.create(
-                        address=args["account_id"],
-                        amount=args["stake_added"],
-                        confirmed_height=block,
-                        hash=args["tx_hash"],
-                    )
-                else:
-                    stake.completed_height = block
-                    stake.save()
-
-                if (
-                    Validator.select()
-                    .where(Validator.address == args["account_id"])
-                    .count()
-                    == 0
-                ):
-                    Validator.create(
-                        address=args["account_id"],
-                        staked_amount=args["stake_added"],
-                        rewards=0,
-                    )
-
-                    self.logger.info(
-                        "Create validator {} with {} stake".format(
-                            args["account_id"], args["tx_hash"]
+                    self.logger.warning("Stake not found for event: %s", event)
+                    changes.create(
+                        Stake(
+                            address=args["account_id"],
+                            amount=args["stake_added"],
+                            completed_height=block,
+                            hash=args["tx_hash"],
                         )
                     )
                 else:
-                    v = Validator.get(Validator.address == args["account_id"])
-                    v.staked_amount += args["stake_added"]
-                    v.save()
+                    stake.completed_height = block
+                    changes.update(stake)
 
-                    self.logger.info(
-                        "Added {} balance to validator {}".format(
-                            args["stake_added"], args["account_id"]
-                        )
-                    )
+                changes.add_validator_stake(args["account_id"], args["stake_added"])
+                self.logger.debug(
+                    "Added %s balance to validator %s",
+                    args["stake_added"],
+                    args["account_id"],
+                )
             elif (
                 event.value["event_id"] == "ThresholdSignatureRequest"
                 and event.value["extrinsic_idx"] != None # if the event is emitted from the validator making the block there is no actual extrinsic
             ):
                 # get original extrinsic
                 identifier = "{}-{}".format(block, event.value["extrinsic_idx"])
-                self.logger.info(
-                    "Found claim initiation with identifier {}".format(identifier)
+                self.logger.debug(
+                    "Found claim initiation with identifier %s", identifier
                 )
 
                 extrinsic = self.chainflip.retrieve_extrinsic_by_identifier(
@@ -309,6 +357,8 @@ class Indexer:
                     continue
 
                 msg_hash = event.value["attributes"][3]
+                addresses.add(extrinsic.value["address"])
+                claims += 1
 
                 if extrinsic.value["call"]["call_args"][0]["value"] == "Max":
                     amount = int(str(self.chainflip.query(
@@ -320,37 +370,49 @@ class Indexer:
                 else:
                     amount = extrinsic.value["call"]["call_args"][0]["value"]["Exact"]
 
-                claim = Claim.select().where(Claim.msg_hash == msg_hash).first()
+                claim = changes.get_claim(msg_hash)
                 if claim == None:
-                    Claim.create(
-                        msg_hash=msg_hash,
-                        initiated_height=block,
-                        chainflip_hash=extrinsic.value["extrinsic_hash"],
-                        amount=amount,
-                        node=extrinsic.value["address"],
+                    changes.create(
+                        Claim(
+                            msg_hash=msg_hash,
+                            initiated_height=block,
+                            chainflip_hash=extrinsic.value["extrinsic_hash"],
+                            amount=amount,
+                            node=extrinsic.value["address"],
+                        )
                     )
                 else:
                     claim.initiated_height = block
                     claim.chainflip_hash = extrinsic.value["extrinsic_hash"]
 
-                    claim.save()
+                    changes.update(claim)
             elif event.value["event_id"] == "ClaimExpired":
-                claim = (
-                    Claim.select()
-                    .where(
-                        Claim.node == event.value["attributes"][0],
-                        Claim.expired_height == None,
-                    )
-                    .order_by(Claim.id.asc())
-                    .first()
-                )
+                claim = changes.pop_unexpired_claim(event.value["attributes"][0])
                 if claim == None:
-                    self.logger.fatal("Claim not found for event: {}".format(event))
+                    self.logger.fatal("Claim not found for event: %s", event)
                     raise Exception("Claim not found")
                 else:
-                    self.logger.info("Claim {} expired".format(claim.id))
+                    self.logger.debug("Claim %s expired", claim.id)
                     claim.expired_height = block
-                    claim.save()
+                    changes.update(claim)
+                    addresses.add(claim.node)
+                    expired_claims += 1
+
+        self.logger.info(
+            "Block %s: %s events, %s stakes, %s claims, %s expired claims",
+            block,
+            len(events),
+            stakes,
+            claims,
+            expired_claims,
+            extra={
+                "block": block,
+                "events": len(events),
+                "stakes": stakes,
+                "claims": claims,
+                "expired_claims": expired_claims,
+            },
+        )
 
         return True
 
@@ -365,39 +427,37 @@ class Indexer:
             return
 
         self.logger.info(
-            "Starting threads for blocks between {} and {}".format(
-                previous_height + 1,
-                min(previous_height + self.batch_size, current_height),
-            )
+            "Starting threads for blocks between %s and %s",
+            previous_height + 1,
+            min(previous_height + self.batch_size, current_height),
         )
 
         blocks = []
         threads = []
         for block in range(previous_height + 1, current_height):
-            with db.atomic():
-                if not self.index_chainflip_block(block):
-                    self.logger.fatal("Block {} failed to sync".format(block))
+            # the height is saved in the block's own transaction
+            if not self.index_chainflip_block(block, save_height=True):
+                self.logger.fatal("Block %s failed to sync", block)
 
-                    quit()
-                else:
-                    self.logger.info("Succesfully synced block {}".format(block))
+                quit()
+            else:
+                self.logger.debug("Succesfully synced block %s", block)
 
-                self.state.chainflip_height += 1
-                self.state.save()
+            self.publish_changes()
 
     def sync_chainflip(self, target_height: int, batch_size: int, thread_delay: float):
         previous_height = self.state.chainflip_height
 
         self.logger.info(
-            "Syncing chainflip from {} to {}".format(previous_height, target_height)
+            "Syncing chainflip from %s to %s", previous_height, target_height
         )
 
         # create batches
         for batch in range(previous_height, target_height, batch_size):
             self.logger.info(
-                "Starting batch {} to {}".format(
-                    batch + 1, min(batch + batch_size, target_height)
-                )
+                "Starting batch %s to %s",
+                batch + 1,
+                min(batch + batch_size, target_height),
             )
 
             blocks = []
@@ -418,22 +478,24 @@ class Indexer:
 
                     if not a:
                         self.logger.fatal(
-                            "Thread returned false, block {} failed to sync".format(
-                                blocks[i]
-                            )
+                            "Thread returned false, block %s failed to sync",
+                            blocks[i],
                         )
                         quit()
                     else:
-                        self.logger.info(
-                            "Thread returned true, block {} succesfully synced".format(
-                                blocks[i]
-                            )
+                        self.logger.debug(
+                            "Thread returned true, block %s succesfully synced",
+                            blocks[i],
                         )
 
                 self.state.chainflip_height = min(batch + batch_size, target_height)
                 self.state.save()
 
+            self.publish_changes()
+
     def start(self):
+        start_logging(self.verbose_logging)
+
         self.watch_eth()
 
         latest = (
@@ -1,18 +1,39 @@
-from indexer import Indexer
-from multiprocessing import Process
-from api import start
+from multiprocessing import get_context
+from models import init_db
+import argparse
 import json
 import time
 
 
+# process entry points import their own dependencies, so neither process pays for the other's
+def run_indexer(config: dict, notifications):
+    from indexer import Indexer
+
+    indexer = Indexer(**config, notifications=notifications)
+    indexer.start()
+
+
+def run_api(config: dict, port: int, notifications):
+    from api import start
+
+    start(config, port, notifications)
+
+
 def main(config_path: str):
     config = json.loads(open(config_path).read())
 
-    indexer = Indexer(**config)
-    sync = Process(target=indexer.start, args=())
+    init_db()
+
+    # spawned processes start from a fresh interpreter rather than a copy of this one
+    context = get_context("spawn")
+
+    # balance change notifications from the sync process to the api process
+    notifications = context.Queue()
+
+    sync = context.Process(target=run_indexer, args=(config, notifications,))
     sync.start()
 
-    api = Process(target=start, args=(indexer, 3000,))
+    api = context.Process(target=run_api, args=(config, 3000, notifications,))
     api.start()
 
     try:
@@ -26,4 +47,23 @@ def main(config_path: str):
 
 
 if __name__ == "__main__":
-    main("./config.json")
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("export-snapshot").add_argument("path")
+    commands.add_parser("import-snapshot").add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "export-snapshot":
+        from snapshot import export_snapshot
+        from utils import start_logging
+
+        start_logging()
+        export_snapshot(args.path)
+    elif args.command == "import-snapshot":
+        from snapshot import import_snapshot
+        from utils import start_logging
+
+        start_logging()
+        import_snapshot(args.path)
+    else:
+        main("./config.json")
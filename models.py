@@ -56,7 +56,9 @@ class Validator(Model):
         database = db
 
 
-db.create_tables([State, Stake, Validator, Claim])
+# schema work is left to the processes that write, so importing models stays cheap
+def init_db():
+    db.create_tables([State, Stake, Validator, Claim])
 
-if State.select().count() == 0:
-    State.create(ethereum_height=0, chainflip_height=0)
+    if State.select().count() == 0:
+        State.create(ethereum_height=0, chainflip_height=0)
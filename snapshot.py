@@ -0,0 +1,176 @@
+from models import *
+from peewee import chunked
+from utils import logger
+import hashlib
+import json
+import struct
+import zlib
+
+# snapshot layout: magic, header length, json header, then one zlib compressed json column after another
+SNAPSHOT_MAGIC = b"CFSNAP1\n"
+SNAPSHOT_TABLES = [State, Stake, Claim, Validator]
+INSERT_BATCH_SIZE = 50
+
+
+class InvalidSnapshot(Exception):
+    pass
+
+
+def export_snapshot(path: str):
+    header = {"tables": {}}
+    blobs = []
+    offset = 0
+
+    # read every table inside one transaction so the heights match the rows
+    with db.atomic():
+        state = State[1]
+        header["ethereum_height"] = state.ethereum_height
+        header["chainflip_height"] = state.chainflip_height
+
+        # sync threads commit rows before the batch height is saved, those rows would be indexed again after an import
+        if has_rows_past(state):
+            raise InvalidSnapshot(
+                "Rows past the indexed heights, stop the indexer before exporting"
+            )
+
+        for model in SNAPSHOT_TABLES:
+            fields = model._meta.sorted_fields
+            rows = list(model.select(*fields).order_by(model.id).tuples())
+
+            columns = []
+            for i, field in enumerate(fields):
+                blob = zlib.compress(
+                    json.dumps([row[i] for row in rows], separators=(",", ":")).encode()
+                )
+                columns.append(
+                    {
+                        "name": field.name,
+                        "offset": offset,
+                        "length": len(blob),
+                        "sha256": hashlib.sha256(blob).hexdigest(),
+                    }
+                )
+                blobs.append(blob)
+                offset += len(blob)
+
+            header["tables"][model._meta.table_name] = {
+                "rows": len(rows),
+                "columns": columns,
+            }
+
+    encoded_header = json.dumps(header).encode()
+    with open(path, "wb") as file:
+        file.write(SNAPSHOT_MAGIC)
+        file.write(struct.pack(">I", len(encoded_header)))
+        file.write(encoded_header)
+        for blob in blobs:
+            file.write(blob)
+
+    logger.info(
+        "Exported snapshot at ethereum height %s and chainflip height %s to %s",
+        header["ethereum_height"],
+        header["chainflip_height"],
+        path,
+    )
+
+
+def has_rows_past(state: State) -> bool:
+    # the ethereum height is stored as the next height to index
+    stakes = Stake.select().where(
+        (Stake.initiated_height >= state.ethereum_height)
+        | (Stake.completed_height > state.chainflip_height)
+    )
+    claims = Claim.select().where(
+        (Claim.completed_height >= state.ethereum_height)
+        | (Claim.initiated_height > state.chainflip_height)
+        | (Claim.expired_height > state.chainflip_height)
+    )
+    return stakes.exists() or claims.exists()
+
+
+def read_snapshot(path: str) -> dict:
+    with open(path, "rb") as file:
+        data = file.read()
+
+    if not data.startswith(SNAPSHOT_MAGIC):
+        raise InvalidSnapshot("{} is not a snapshot".format(path))
+
+    start = len(SNAPSHOT_MAGIC)
+    (header_length,) = struct.unpack(">I", data[start : start + 4])
+    start += 4
+    header = json.loads(data[start : start + header_length])
+    start += header_length
+
+    tables = {}
+    for model in SNAPSHOT_TABLES:
+        table = header["tables"].get(model._meta.table_name)
+        if table is None:
+            raise InvalidSnapshot(
+                "Table {} missing from snapshot".format(model._meta.table_name)
+            )
+
+        columns = {}
+        for column in table["columns"]:
+            if column["name"] not in model._meta.fields:
+                raise InvalidSnapshot(
+                    "Unknown column {}.{}".format(
+                        model._meta.table_name, column["name"]
+                    )
+                )
+
+            blob = data[
+                start + column["offset"] : start + column["offset"] + column["length"]
+            ]
+            if hashlib.sha256(blob).hexdigest() != column["sha256"]:
+                raise InvalidSnapshot(
+                    "Checksum mismatch for {}.{}".format(
+                        model._meta.table_name, column["name"]
+                    )
+                )
+
+            values = json.loads(zlib.decompress(blob))
+            if len(values) != table["rows"]:
+                raise InvalidSnapshot(
+                    "Row count mismatch for {}.{}".format(
+                        model._meta.table_name, column["name"]
+                    )
+                )
+            columns[column["name"]] = values
+
+        # a missing column would renumber rows or fail part way through the import
+        if len(columns) != len(table["columns"]) or set(columns) != set(
+            model._meta.fields
+        ):
+            raise InvalidSnapshot(
+                "Columns of {} don't match the model".format(model._meta.table_name)
+            )
+
+        tables[model] = columns
+
+    return {
+        "ethereum_height": header["ethereum_height"],
+        "chainflip_height": header["chainflip_height"],
+        "tables": tables,
+    }
+
+
+def import_snapshot(path: str):
+    # everything is verified before the database is touched
+    snapshot = read_snapshot(path)
+    init_db()
+
+    with db.atomic():
+        for model, columns in snapshot["tables"].items():
+            fields = [model._meta.fields[name] for name in columns]
+            rows = zip(*columns.values())
+
+            model.delete().execute()
+            for batch in chunked(rows, INSERT_BATCH_SIZE):
+                model.insert_many(batch, fields=fields).execute()
+
+    logger.info(
+        "Imported snapshot at ethereum height %s and chainflip height %s from %s",
+        snapshot["ethereum_height"],
+        snapshot["chainflip_height"],
+        path,
+    )
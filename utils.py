@@ -1,5 +1,8 @@
 import json
+import atexit
 import logging
+import logging.handlers
+import queue
 from scalecodec import ScaleBytes
 from pydantic import BaseModel
 
@@ -22,12 +25,23 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: bold_red + format + reset,
     }
 
+    def __init__(self):
+        super().__init__()
+        self.formatters = {
+            level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()
+        }
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self.formatters.get(record.levelno, self.formatters[logging.INFO])
         return formatter.format(record)
 
 
+# hands records to the listener thread untouched, so message interpolation and formatting happen off the caller's thread
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
 # create logger with 'spam_application'
 logger = logging.getLogger("Indexer")
 logger.setLevel(logging.INFO)
@@ -38,8 +52,29 @@ ch.setLevel(logging.DEBUG)
 
 ch.setFormatter(CustomFormatter())
 
+# records go straight to the console until start_logging moves them onto the listener thread
 logger.addHandler(ch)
 
+listener = None
+
+
+# threads don't survive a fork, so every process that logs starts its own listener
+def start_logging(verbose: bool = False):
+    global listener
+
+    logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+
+    if listener is not None:
+        return
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, ch)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger.removeHandler(ch)
+    logger.addHandler(LazyQueueHandler(log_queue))
+
 
 def get_abi(path: str) -> dict:
     file = open(path, "r")